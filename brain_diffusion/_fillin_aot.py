@@ -0,0 +1,37 @@
+"""
+Ahead-of-time build of the fillin2 carryover kernel.
+
+Running
+
+    python -m brain_diffusion._fillin_aot
+
+compiles the kernel into a brain_diffusion.fillin_aot extension module next
+to this file.  msd.fillin2 uses the extension when it can be imported, which
+avoids compiling the kernel with numba in every new process.  The extension
+records a hash of the kernel source it was built from; if _fillin_carryover
+has changed since, msd warns and ignores the extension until it is rebuilt.
+"""
+
+import os
+from numba.pycc import CC
+
+from brain_diffusion.msd import _fillin_carryover, _kernel_hash
+
+cc = CC('fillin_aot')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+kernel = getattr(_fillin_carryover, 'py_func', _fillin_carryover)
+KERNEL_VERSION = _kernel_hash(kernel)
+
+
+def kernel_version():
+    return KERNEL_VERSION
+
+
+cc.export('kernel_version', 'i8()')(kernel_version)
+cc.export('fillin2_gather', 'f8[:, :](f8[:, :], i8, i8)')(kernel)
+cc.export('fillin2_gather_f4', 'f4[:, :](f4[:, :], i8, i8)')(kernel)
+
+
+if __name__ == '__main__':
+    cc.compile()
@@ -1,14 +1,71 @@
 import os
 import csv
 import sys
+import hashlib
+import inspect
+import warnings
 import scipy.optimize as opt
 import scipy.stats as stat
 from operator import itemgetter
 import random
 import numpy as np
-import numpy.ma as ma
 import numpy.linalg as la
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; fall back to plain numpy.
+    njit = None
+    prange = range
+
+try:
+    from brain_diffusion import fillin_aot
+except ImportError:  # built by python -m brain_diffusion._fillin_aot
+    fillin_aot = None
+
+
+def _fillin_carryover(data, shape1, newshap):
+    """
+    Compiled core of fillin2.  Walks the frames once, carrying the last
+    recorded row forward over skipped frames.
+    """
+
+    filledin = np.zeros((newshap, 5), dtype=data.dtype)
+    row = 0
+    for num in range(newshap):
+        frame = shape1 + num
+        while row + 1 < data.shape[0] and data[row + 1, 1] <= frame:
+            row = row + 1
+        filledin[num, 0] = data[row, 0]
+        filledin[num, 1] = frame
+        filledin[num, 2:5] = data[row, 2:5]
+
+    return filledin
+
+
+def _kernel_hash(func):
+    """
+    Hash of a kernel's source code, used to tell whether the ahead-of-time
+    fillin_aot extension was built from the kernel currently in this file.
+    Returns None if the source is unavailable.
+    """
+
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        return None
+    return int(hashlib.sha1(source.encode()).hexdigest()[:15], 16)
+
+
+if fillin_aot is not None:
+    built_from = getattr(fillin_aot, 'kernel_version', lambda: None)()
+    if built_from is None or built_from != _kernel_hash(_fillin_carryover):
+        warnings.warn('brain_diffusion.fillin_aot was built from a different fillin2 kernel and will not '
+                      'be used.  Rebuild it with python -m brain_diffusion._fillin_aot.')
+        fillin_aot = None
+
+if njit is not None:
+    _fillin_carryover = njit(cache=True)(_fillin_carryover)
+
 
 def fillin2(data):
     """
@@ -35,9 +92,9 @@ def fillin2(data):
     >>> n = 6
     >>> df = np.zeros((6, 5))
     >>> df[:, 0] = np.ones(6)
-    >>> df[:, 1] = np.linspace(0, 100, 6)
-    >>> df[:, 2] = np.linspace(0, 100, 6)
-    >>> df[:, 3] = np.linspace(0, 100, 6)
+    >>> df[:, 1] = np.linspace(0, 10, 6)
+    >>> df[:, 2] = np.linspace(0, 10, 6)
+    >>> df[:, 3] = np.linspace(0, 10, 6)
     >>> df[:, 4] = np.zeros(6)
     >>> fillin2(df)
     array([[  1.,   0.,   0.,   0.,   0.],
@@ -62,28 +119,23 @@ def fillin2(data):
     shap = int(max(data[:, 1])) + 1
     shape1 = int(min(data[:, 1]))
     newshap = shap - shape1
-    filledin = np.zeros((newshap, 5))
-    filledin[0, :] = data[0, :]
+
+    if fillin_aot is not None and data.dtype == np.float64:
+        return fillin_aot.fillin2_gather(data, shape1, newshap)
+    if fillin_aot is not None and data.dtype == np.float32:
+        return fillin_aot.fillin2_gather_f4(data, shape1, newshap)
+    if njit is not None:
+        return _fillin_carryover(data, shape1, newshap)
+
+    filledin = np.zeros((newshap, 5), dtype=data.dtype)
     frames = data[:, 1]
-    filledin[:, 1] = np.linspace(shape1, shap-1, newshap)
-
-    count = 0
-    new = 0
-    other = 0
-    tot = 0
-
-    for num in range(1, newshap):
-        # if a frame isn't skipped
-        if filledin[num, 1]-frames[num-new-1] == 0:
-            count = count + 1
-        elif filledin[num, 1]-frames[num-new-1] < 0:
-            new = new + 1
-        else:
-            other = other + 1
-
-        filledin[num, 0] = data[num-new-1, 0]
-        filledin[num, 2:5] = data[num-new-1, 2:5]
-        tot = count + new + other
+    all_frames = np.arange(shape1, shap)
+
+    # Each frame takes the last recorded row at or before it.
+    idx = np.clip(np.searchsorted(frames, all_frames, side='right') - 1, 0, None)
+    filledin[:, 0] = data[idx, 0]
+    filledin[:, 1] = all_frames
+    filledin[:, 2:5] = data[idx, 2:5]
 
     return filledin
 
@@ -125,7 +177,7 @@ def MSD_iteration(folder, name, cut=1, totvids=1, conversion=(1, 1, 1)):
     x_m : numpy array of dimensions frames x particles
         Contains x coordinates of all trajectories in all csv files being
         analyzed.  If a particle isn't present in a frame, then it is filled in
-        with a 0.
+        with a 0.  All four coordinate arrays are float32.
     y_m : numpy array of dimensions frames x particles
         Similar to x_m with y coordinates.
     xs_m : numpy array of dimensions frames x particles
@@ -166,8 +218,6 @@ def MSD_iteration(folder, name, cut=1, totvids=1, conversion=(1, 1, 1)):
     assert type(conversion) is tuple, "conversion must be a tuple"
     assert len(conversion) == 3, "conversion must contain 3 elements"
 
-    frames = 0
-    trajectory = dict()
     tots = dict()  # Total particles in each video
     newtots = dict()  # Cumulative total particles.
     newtots[0] = 0
@@ -175,72 +225,151 @@ def MSD_iteration(folder, name, cut=1, totvids=1, conversion=(1, 1, 1)):
     tlength = dict()
     tlength[0] = 0
 
+    # Count the data rows in each file first so that every video can be parsed
+    # straight into its slice of one table, rather than held separately and
+    # copied in afterwards.
     for num in range(1, totvids + 1):
-        trajectory[num] = np.genfromtxt(folder+'Traj_{}_{}.tif.csv'.format(name, num), delimiter=",")
-        trajectory[num] = np.delete(trajectory[num], 0, 0)
-        trajectory[num] = np.delete(trajectory[num], 0, 1)
+        with open(folder+'Traj_{}_{}.tif.csv'.format(name, num)) as f:
+            tlen[num] = sum(1 for line in f if line.strip()) - 1
+        tlength[num] = tlength[num-1] + tlen[num]
+
+    placeholder = np.empty((tlength[totvids], 11), dtype=np.float32)
+
+    for num in range(1, totvids + 1):
+        rows = placeholder[tlength[num-1]:tlength[num], :]
+        # Skip the header row and the leading index column while parsing.
+        rows[:, :] = np.loadtxt(folder+'Traj_{}_{}.tif.csv'.format(name, num), delimiter=",", skiprows=1,
+                                usecols=range(1, 12), dtype=np.float32, ndmin=2)
 
-        tots[num] = trajectory[num][-1, 0].astype(np.int64)
+        tots[num] = rows[-1, 0].astype(np.int64)
         newtots[num] = newtots[num-1] + tots[num]
+        rows[:, 0] = rows[:, 0] + newtots[num-1]
+
+    frames = int(np.max(placeholder[:, 1]))
+
+    # Group rows by particle once rather than scanning the whole table for
+    # every particle.  A stable sort keeps the frames of each trajectory in
+    # their original order.  Only the ID, frame and xyz columns are kept.
+    fixed = placeholder[np.argsort(placeholder[:, 0], kind='stable'), 0:5]
+    fixed[:, 2:4] *= conversion[0]
+    fixed[:, 4] *= conversion[2]
+    ids, starts, counts = np.unique(fixed[:, 0], return_index=True, return_counts=True)
+    keep = (ids > 0) & (counts - 1 >= cut)
+    total1 = int(np.count_nonzero(keep))
+
+    # One float32 block holding each coordinate set as a contiguous
+    # frames x particles plane, sized for the trajectories that pass the cut.
+    coords = np.zeros((4, frames+1, total1), dtype=np.float32)
+    xs_m, ys_m, x_m, y_m = coords
+
+    for num, (start, count) in enumerate(zip(starts[keep], counts[keep])):
+        holdplease = fillin2(fixed[start:start+count])
+        first = int(holdplease[0, 1])
+        last = int(holdplease[-1, 1])
+        x_m[first:last+1, num] = holdplease[:, 2]
+        y_m[first:last+1, num] = holdplease[:, 3]
+
+        xs_m[0:last+1-first, num] = holdplease[:, 2]
+        ys_m[0:last+1-first, num] = holdplease[:, 3]
 
-        tlen[num] = trajectory[num].shape[0]
-        tlength[num] = tlength[num-1] + tlen[num]
+    return total1, frames, xs_m, ys_m, x_m, y_m
 
-        if np.max(trajectory[num][:, 1]) > frames:
-            frames = int(np.max(trajectory[num][:, 1]))
 
-    placeholder = np.zeros((tlength[totvids], 11))
+def _msd_lags(xys, frames, msd):
+    """
+    Compiled lag loop of _msd_direct.  Each lag makes one pass down the
+    frames, reading whole rows so memory is walked contiguously, and
+    subtracts, squares and accumulates in place.  Lags are independent, so
+    they are spread across threads.
+    """
 
-    for num in range(1, totvids + 1):
-        placeholder[tlength[num-1]:tlength[num], :] = trajectory[num]
-        placeholder[tlength[num-1]:tlength[num], 0] = placeholder[tlength[num-1]:tlength[num], 0] + newtots[num-1]
-
-    dataset = dict()
-    rawdataset = np.zeros(placeholder.shape)
-    particles = placeholder[:, 0]
-    total = int(max(particles))
-    total1 = total + 1
-    rawdataset = placeholder[:, :]
-
-    fixed = np.zeros(placeholder.shape)
-    fixed[:, 0:2] = rawdataset[:, 0:2]
-    fixed[:, 2:4] = conversion[0] * rawdataset[:, 2:4]
-    fixed[:, 4] = conversion[2] * rawdataset[:, 4]
-
-    x = np.zeros((frames+1, total1))
-    y = np.zeros((frames+1, total1))
-    xs = np.zeros((frames+1, total1))
-    ys = np.zeros((frames+1, total1))
-
-    nones = 0
-    cutoff = cut
-    for num in range(1, total1):
-
-        hold = np.where(particles == num)
-        itindex = hold[0]
-        min1 = min(itindex)
-        max1 = max(itindex)
-
-        if max1 - min1 < cutoff:
-            nones = nones + 1
-        else:
-            holdplease = fillin2(fixed[min1:max1+1, 0:5])
-            x[int(holdplease[0, 1]):int(holdplease[-1, 1])+1, num - nones - 1] = holdplease[:, 2]
-            y[int(holdplease[0, 1]):int(holdplease[-1, 1])+1, num - nones - 1] = holdplease[:, 3]
-
-            xs[0:int(holdplease[-1, 1])+1-int(holdplease[0, 1]), num - nones - 1] = holdplease[:, 2]
-            ys[0:int(holdplease[-1, 1])+1-int(holdplease[0, 1]), num - nones - 1] = holdplease[:, 3]
-
-    total1 = total1 - nones - 1
-    x_m = x[:, :total1]
-    y_m = y[:, :total1]
-    xs_m = xs[:, :total1]
-    ys_m = ys[:, :total1]
+    ncomp, n, npar = xys.shape
+    for frame in prange(1, frames):
+        acc = np.zeros((ncomp, npar))
+        count = np.zeros((ncomp, npar))
+        for t in range(n - frame):
+            for k in range(ncomp):
+                for p in range(npar):
+                    a = xys[k, t + frame, p]
+                    b = xys[k, t, p]
+                    if a != 0 and b != 0:
+                        acc[k, p] += (a - b) * (a - b)
+                        count[k, p] += 1
+        for k in range(ncomp):
+            for p in range(npar):
+                if count[k, p] > 0:
+                    msd[k, frame, p] = acc[k, p] / count[k, p]
+
+
+if njit is not None:
+    _msd_lags = njit(parallel=True, fastmath=True, cache=True)(_msd_lags)
+
+
+def _msd_direct(xys, frames):
+    """
+    Mean squared displacements of each column of xys at lags 0 to frames - 1,
+    computed lag by lag.  xys stacks the coordinate components as
+    components x frames x particles so that all components are differenced
+    together.  Zeros are treated as missing positions, and each lag is
+    averaged over the pairs of positions that are both present.
+    """
 
-    return total1, frames, xs_m, ys_m, x_m, y_m
+    msd = np.zeros((xys.shape[0], frames, xys.shape[2]))
+
+    if njit is not None:
+        _msd_lags(xys, frames, msd)
+        return msd
+
+    valid = xys != 0
+    for frame in range(1, frames):
+        pairs = valid[:, frame:, :] & valid[:, :-frame, :]
+        diff = (xys[:, frame:, :] - xys[:, :-frame, :]) * pairs
+        counts = pairs.sum(axis=1)
+        sq = np.einsum('kij,kij->kj', diff, diff, dtype=np.float64)
+        np.divide(sq, counts, out=msd[:, frame, :], where=counts > 0)
+
+    return msd
+
+
+def _msd_fft(xys, frames):
+    """
+    Mean squared displacements of each column of xys at lags 0 to frames - 1,
+    computed from FFT correlations.  xys is laid out as in _msd_direct.  Zeros
+    are treated as missing positions, and each lag is averaged over the pairs
+    of positions that are both present.
+    """
+
+    n = xys.shape[1]
+    size = 2 * n
+    valid = (xys != 0).astype(np.float64)
+    counts = valid.sum(axis=1, keepdims=True)
+    # MSDs don't depend on the origin; centering each track keeps the
+    # squared terms small so they cancel cleanly.
+    centers = xys.sum(axis=1, keepdims=True, dtype=np.float64) / np.where(counts > 0, counts, 1)
+    xc = (xys - centers) * valid
+
+    fw = np.fft.rfft(valid, size, axis=1)
+    fx = np.fft.rfft(xc, size, axis=1)
+    fx2 = np.fft.rfft(xc**2, size, axis=1)
+
+    # sum_t w[t]w[t+m](x[t+m] - x[t])**2 expanded into three correlations.
+    pairs = np.rint(np.fft.irfft(fw.conj() * fw, size, axis=1)[:, :frames])
+    sq = np.fft.irfft(fw.conj() * fx2 + fx2.conj() * fw - 2 * fx.conj() * fx, size, axis=1)[:, :frames]
+
+    # The correlations cancel to rounding residue, not 0, when the true sum
+    # is 0 (e.g. a stationary track).  Residue of either sign would otherwise
+    # be logged later as a real MSD, so cut it relative to the track's size.
+    energy = (xc**2).sum(axis=1, keepdims=True)
+    sq[sq <= 2 * size * np.finfo(np.float64).eps * energy] = 0
+
+    msd = np.zeros((xys.shape[0], frames, xys.shape[2]))
+    np.divide(sq, pairs, out=msd, where=pairs > 0)
+    msd[:, 0, :] = 0
+
+    return msd
 
 
-def vectorized_MMSD_calcs(frames, total1, xs_m, ys_m):
+def vectorized_MMSD_calcs(frames, total1, xs_m, ys_m, fft=False):
     """
     Calculates the geometrically averaged mean squared displacement of the input trajectories.
 
@@ -257,6 +386,11 @@ def vectorized_MMSD_calcs(frames, total1, xs_m, ys_m):
         begin at frame 0. Output from MSD_iteration.
     ys_m : numpy array of dimensions frames x particles
         Similar to xs_m with y coordinates. Output from MSD_iteration.
+    fft : boolean
+        If True, MSDs are calculated from FFT correlations, which scales as
+        N log N rather than N^2 in the number of frames.  Results agree with
+        the default direct calculation to floating point precision, and
+        MSDs that are exactly 0 there (such as stationary tracks) are also 0.
 
     Returns
     -------
@@ -347,35 +481,27 @@ def vectorized_MMSD_calcs(frames, total1, xs_m, ys_m):
     assert type(ys_m) is np.ndarray, 'ys_m must an a numpy array'
     assert xs_m.shape == ys_m.shape, 'xs_m and ys_m must be the same size'
 
-    SM1x = np.zeros((frames, total1))
-    SM1y = np.zeros((frames, total1))
-    SM2xy = np.zeros((frames, total1))
+    assert type(fft) is bool, 'fft must be a boolean'
 
-    xs_m = ma.masked_equal(xs_m, 0)
-    ys_m = ma.masked_equal(ys_m, 0)
-
-    geoM1x = np.zeros(frames)
-    geoM1y = np.zeros(frames)
-
-    for frame in range(1, frames):
-        bx = xs_m[frame:, :]
-        cx = xs_m[:-frame, :]
-        Mx = (bx - cx)**2
-        Mxa = np.mean(Mx, axis=0)
-
-        by = ys_m[frame:, :]
-        cy = ys_m[:-frame, :]
-        My = (by - cy)**2
-        Mya = np.mean(My, axis=0)
-
-        SM1x[frame, :] = Mxa
-        SM1y[frame, :] = Mya
+    # np.stack gives a fresh C-contiguous block, so each lag slice below is a
+    # plain strided view that numpy's ufuncs and the numba kernel can stream
+    # through.  The input dtype is kept; MSD_iteration output is float32.
+    xys = np.stack((xs_m, ys_m))
+    if fft:
+        SM1x, SM1y = _msd_fft(xys, frames)
+    else:
+        SM1x, SM1y = _msd_direct(xys, frames)
 
     SM2xy = SM1x + SM1y
-    dist = ma.log(ma.masked_equal(SM2xy, 0))
 
-    geoM2xy = ma.mean(dist, axis=1)
+    # Zero MSDs are missing trajectories; leave them out of the log average.
+    valid = SM2xy != 0
+    counts = valid.sum(axis=1)
+    dist = np.zeros(SM2xy.shape)
+    np.log(SM2xy, out=dist, where=valid)
+
+    geoM2xy = np.zeros(frames)
+    np.divide(dist.sum(axis=1), counts, out=geoM2xy, where=counts > 0)
     gSEM = stat.sem(dist, axis=1)
-    geoM2xy = geoM2xy.data
 
     return geoM2xy, gSEM, SM1x, SM1y, SM2xy
@@ -9,11 +9,31 @@ import numpy as np
 import numpy.ma as ma
 import numpy.linalg as la
 import numpy.testing as npt
+import pytest
 
+from brain_diffusion import msd
 from brain_diffusion.msd import fillin2, MSD_iteration, vectorized_MMSD_calcs
 
 
-def test_fillin2():
+def use_fillin_path(monkeypatch, path):
+    """
+    Forces fillin2 onto one implementation: the ahead-of-time build ('aot'),
+    the numba kernel ('numba'), or plain numpy ('numpy').
+    """
+
+    if path == 'aot' and msd.fillin_aot is None:
+        pytest.skip('fillin_aot extension not built')
+    if path == 'numba' and msd.njit is None:
+        pytest.skip('numba not installed')
+    if path != 'aot':
+        monkeypatch.setattr(msd, 'fillin_aot', None)
+    if path == 'numpy':
+        monkeypatch.setattr(msd, 'njit', None)
+
+
+@pytest.mark.parametrize('path', ['aot', 'numba', 'numpy'])
+def test_fillin2(monkeypatch, path):
+    use_fillin_path(monkeypatch, path)
     n = 6
     df = np.zeros((n, 5))
     df[:, 0] = np.ones(n)
@@ -38,6 +58,25 @@ def test_fillin2():
     npt.assert_equal(test, fillin2(df))
 
 
+@pytest.mark.parametrize('path', ['aot', 'numba', 'numpy'])
+def test_fillin2_consecutive_frames(monkeypatch, path):
+    use_fillin_path(monkeypatch, path)
+    df = np.zeros((4, 5))
+    df[:, 0] = np.ones(4)
+    df[:, 1] = np.array([0, 1, 2, 5])
+    df[:, 2] = np.array([10, 11, 12, 15])
+    df[:, 3] = np.array([20, 21, 22, 25])
+
+    test = np.array([[1.,   0.,  10.,  20.,   0.],
+                     [1.,   1.,  11.,  21.,   0.],
+                     [1.,   2.,  12.,  22.,   0.],
+                     [1.,   3.,  12.,  22.,   0.],
+                     [1.,   4.,  12.,  22.,   0.],
+                     [1.,   5.,  15.,  25.,   0.]])
+
+    npt.assert_equal(test, fillin2(df))
+
+
 def test_MSD_iteration():
     n = 6
     p = 2
@@ -171,3 +210,76 @@ def test_vectorized_MMSD_calcs():
     npt.assert_equal(test3, SM1x)
     npt.assert_equal(test3, SM1y)
     npt.assert_equal(2*test3, SM2xy)
+
+
+def test_vectorized_MMSD_calcs_fft():
+    nframe = 40
+    npar = 5
+    rand = np.random.RandomState(0)
+    xs_m = np.cumsum(rand.normal(size=(nframe, npar)), axis=0) + 100
+    ys_m = np.cumsum(rand.normal(size=(nframe, npar)), axis=0) + 100
+    for i in range(npar):
+        xs_m[nframe - 3*i - 5:, i] = 0
+        ys_m[nframe - 3*i - 5:, i] = 0
+    xs_m[7, 2] = 0
+    xs_m[10:12, 3] = 0
+
+    direct = vectorized_MMSD_calcs(nframe - 1, npar, xs_m, ys_m)
+    fft = vectorized_MMSD_calcs(nframe - 1, npar, xs_m, ys_m, fft=True)
+
+    npt.assert_allclose(direct[2], fft[2], atol=1e-9)
+    npt.assert_allclose(direct[3], fft[3], atol=1e-9)
+    npt.assert_allclose(direct[4], fft[4], atol=1e-9)
+    npt.assert_allclose(direct[0], fft[0], atol=1e-9)
+    npt.assert_allclose(direct[1], fft[1], atol=1e-9)
+
+
+def test_vectorized_MMSD_calcs_fft_stationary():
+    nframe = 30
+    npar = 3
+    rand = np.random.RandomState(1)
+    xs_m = np.cumsum(rand.normal(size=(nframe, npar)), axis=0) + 100
+    ys_m = np.cumsum(rand.normal(size=(nframe, npar)), axis=0) + 100
+    xs_m[:, 1] = 100.1
+    ys_m[:, 1] = 57.3
+    xs_m[20:, 2] = 0
+    ys_m[20:, 2] = 0
+
+    direct = vectorized_MMSD_calcs(nframe - 1, npar, xs_m, ys_m)
+    fft = vectorized_MMSD_calcs(nframe - 1, npar, xs_m, ys_m, fft=True)
+
+    npt.assert_equal(np.zeros(nframe - 1), fft[4][:, 1])
+    assert not np.any(np.isnan(fft[0]))
+    npt.assert_allclose(direct[0], fft[0], atol=1e-9)
+    npt.assert_allclose(direct[1], fft[1], atol=1e-9)
+
+
+def test_vectorized_MMSD_calcs_numba_matches_numpy(monkeypatch):
+    if msd.njit is None:
+        pytest.skip('numba not installed')
+    n = 6
+    p = 2
+    df = np.zeros((p*n, 12))
+    for i in range(1, p+1):
+        df[(i-1)*n:i*n, 0] = np.ones(n) + i - 1
+        df[(i-1)*n:i*n, 1] = np.ones(n) + i - 1
+        df[(i-1)*n:i*n, 2] = np.linspace(0, 10, n) + 2 + i
+        df[(i-1)*n:i*n, 3] = np.linspace(0, 10, n) + i
+        df[(i-1)*n:i*n, 4] = np.linspace(0, 10, n) + 3 + i
+        df[(i-1)*n:i*n, 5] = np.zeros(n)
+        df[(i-1)*n:i*n, 6:12] = np.zeros((n, 6))
+    np.savetxt("../Traj_test_data_1.tif.csv", df, delimiter=",")
+    folder = '../'
+    name = 'test_data'
+    total1, frames, xs_m, ys_m, x_m, y_m = MSD_iteration(folder, name)
+    xs_m = xs_m.copy()
+    ys_m = ys_m.copy()
+    xs_m[3, 1] = 0
+    ys_m[5:7, 0] = 0
+
+    compiled = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m)
+    monkeypatch.setattr(msd, 'njit', None)
+    numpy = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m)
+
+    for a, b in zip(compiled, numpy):
+        npt.assert_equal(a, b)